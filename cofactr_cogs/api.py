@@ -1,9 +1,16 @@
 import os
 import sys
-from dataclasses import dataclass
+import threading
+import time
+from bisect import bisect_right
+from collections.abc import Iterable, Iterator
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, field
 from enum import Enum
 
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
 
 
 class SearchStrategy(Enum):
@@ -20,14 +27,202 @@ class SearchStrategy(Enum):
         return self == SearchStrategy.MPN_SKU_MFR
 
 
+COFACTR_PRODUCTS_URL = "https://graph.cofactr.com/products/"
+
+# The number of price requests to have in flight at once. Fetching prices is
+# dominated by waiting on the Cofactr API, so overlapping requests is what
+# keeps large BOMs fast.
+MAX_CONCURRENT_REQUESTS = 16
+
+# The default number of requests per second to send to Cofactr. Going faster
+# than the API allows just gets requests rejected with 429s.
+DEFAULT_REQUESTS_PER_SECOND = 30.0
+
+# How long to wait, in seconds, to connect to Cofactr and then for each read
+# of its response, before giving up on the attempt.
+REQUEST_TIMEOUT = (10, 30)
+
+# How many times to retry a request that Cofactr rate limits, fails with a
+# transient server error, or that fails to connect or times out. Rate limited
+# requests pause for as long as Cofactr asks, or DEFAULT_RETRY_AFTER seconds if
+# it doesn't say, and anything else is retried after RETRY_BACKOFF seconds,
+# doubling after each attempt.
+MAX_RETRIES = 5
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+DEFAULT_RETRY_AFTER = 1.0
+RETRY_BACKOFF = 0.3
+
+
+class RateLimiter:
+    """
+    A token bucket that limits how often requests are sent.
+
+    Up to `rate` requests can be sent in a burst, after which requests are
+    sent at `rate` per second. It is safe to share between threads.
+    """
+
+    def __init__(self, rate: float) -> None:
+        if rate <= 0:
+            raise ValueError("The request rate must be positive.")
+        self.rate = rate
+        self.tokens = rate
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+        # Counts calls to `pause`, so that callers already waiting can tell
+        # that they need to wait for the pause too.
+        self.pauses = 0
+        self.lock = threading.Lock()
+
+    def wait(self) -> None:
+        """
+        Block until another request can be sent.
+        """
+
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    delay = self.paused_until - now
+                    pauses = None
+                else:
+                    self._refill()
+                    # Take a token even if there isn't one yet, so that callers
+                    # waiting at the same time queue up behind each other
+                    # instead of all being let through when the next token is
+                    # added.
+                    self.tokens -= 1
+                    delay = -self.tokens / self.rate if self.tokens < 0 else 0
+                    pauses = self.pauses
+
+            if pauses is not None and delay <= 0:
+                return
+            time.sleep(delay)
+            if pauses is not None:
+                with self.lock:
+                    if self.pauses == pauses:
+                        return
+                # The limiter was paused while we waited, which gave up our
+                # token, so queue up again.
+
+    def pause(self, seconds: float) -> None:
+        """
+        Stop any more requests being sent for at least `seconds`.
+
+        This is for when the API says we have sent too many requests: every
+        thread sharing the limiter backs off, including those already waiting
+        in `wait`, rather than each of them finding out separately. Pauses from
+        requests that were rejected at the same time overlap rather than add
+        up. Once the pause is over, requests start again at `rate` per second
+        rather than in a burst.
+        """
+
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0
+            self.updated_at = self.paused_until
+            self.pauses += 1
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        elapsed = max(now - self.updated_at, 0)
+        self.tokens = min(self.rate, self.tokens + elapsed * self.rate)
+        self.updated_at = max(now, self.updated_at)
+
+
+@dataclass
+class FetchConfig:
+    """
+    Everything needed to fetch prices from Cofactr, set up once per run.
+
+    Use `fetch_config_from_environment` to create one.
+    """
+
+    session: requests.Session
+    rate_limiter: RateLimiter
+    search_strategy: SearchStrategy
+    search_strategy_query_value: str
+    needs_mfr: bool
+
+
+def create_session(api_key: str, client_id: str) -> requests.Session:
+    """
+    Create a session for talking to the Cofactr API.
+
+    Sharing one session across lookups keeps connections to Cofactr alive and
+    reuses them, rather than paying for a new TCP and TLS handshake on every
+    request. The pool holds a connection for every concurrent request, so
+    requests never wait on each other for a connection.
+
+    The session doesn't retry anything itself. Rate limited requests, transient
+    server errors and connection errors are retried by `fetch_price_for_part`,
+    so that every retry is counted by the `RateLimiter` too.
+    """
+
+    session = requests.Session()
+    session.headers.update(
+        {
+            "X-API-KEY": api_key,
+            "X-CLIENT-ID": client_id,
+        }
+    )
+    session.mount(
+        "https://",
+        HTTPAdapter(pool_maxsize=MAX_CONCURRENT_REQUESTS),
+    )
+    return session
+
+
+def fetch_config_from_environment(
+    search_strategy: SearchStrategy,
+    requests_per_second: float = DEFAULT_REQUESTS_PER_SECOND,
+) -> FetchConfig:
+    """
+    Create a `FetchConfig` using the Cofactr credentials in the
+    COFACTR_API_KEY and COFACTR_CLIENT_ID environment variables.
+    """
+
+    api_key = os.environ.get("COFACTR_API_KEY")
+    client_id = os.environ.get("COFACTR_CLIENT_ID")
+    if api_key is None or client_id is None:
+        raise ValueError(
+            "Please set the COFACTR_API_KEY and COFACTR_CLIENT_ID environment variables"
+        )
+
+    return FetchConfig(
+        session=create_session(api_key, client_id),
+        rate_limiter=RateLimiter(requests_per_second),
+        search_strategy=search_strategy,
+        search_strategy_query_value=search_strategy.to_query_value(),
+        needs_mfr=search_strategy.query_needs_manufacturer(),
+    )
+
+
 @dataclass
 class PartPrices:
     cofactr_id: str
     prices: dict[int, float]
+    # The breakpoints in ascending order, and the price at each of them, so
+    # that the price at a quantity can be found with a binary search.
+    breakpoints: list[int] = field(init=False, repr=False)
+    breakpoint_prices: list[float] = field(init=False, repr=False)
+
+    def __post_init__(self) -> None:
+        self.breakpoints = sorted(self.prices)
+        self.breakpoint_prices = [self.prices[breakpoint] for breakpoint in self.breakpoints]
+
+    def price_at(self, quantity: int) -> float | None:
+        """
+        Get the price per unit when buying `quantity` units, i.e. the price at
+        the largest breakpoint that is at most `quantity`. Returns None if
+        there is no such breakpoint.
+        """
+
+        index = bisect_right(self.breakpoints, quantity) - 1
+        return self.breakpoint_prices[index] if index >= 0 else None
 
 
 def fetch_price_for_part(
-    part_number: str, manufacturer: str, search_strategy: SearchStrategy
+    config: FetchConfig, part_number: str, manufacturer: str
 ) -> PartPrices | None:
     """
     Get the price of a component per n units.
@@ -53,38 +248,51 @@ def fetch_price_for_part(
     API, such as Octopart or TrustedParts. You have access to the `requests`
     python library to perform HTTP requests.
 
+    :param config: The session and search strategy to use.
     :param part_number: A part number by which to search for the component.
+    :param manufacturer: The manufacturer of the component, if known.
     :returns: A mapping of price breakpoints to the price at that breakpoint.
     """
 
     if part_number.startswith("NOTAPART"):
         return None
 
-    api_key = os.environ.get("COFACTR_API_KEY")
-    client_id = os.environ.get("COFACTR_CLIENT_ID")
-    if api_key is None or client_id is None:
-        raise ValueError(
-            "Please set the COFACTR_API_KEY and COFACTR_CLIENT_ID environment variables"
-        )
-
     query = part_number
-    if search_strategy.query_needs_manufacturer() and manufacturer:
+    if config.needs_mfr and manufacturer:
         query += f" {manufacturer}"
 
-    search_response = requests.get(
-        "https://graph.cofactr.com/products/",
-        headers={
-            "X-API-KEY": api_key,
-            "X-CLIENT-ID": client_id,
-        },
-        params={
-            "q": query,
-            "search_strategy": search_strategy.to_query_value(),
-            "schema": "product-offers-v0",
-            "external": "true",
-            "limit": "1",
-        },
-    )
+    for attempt in range(MAX_RETRIES + 1):
+        config.rate_limiter.wait()
+        try:
+            search_response = config.session.get(
+                COFACTR_PRODUCTS_URL,
+                params={
+                    "q": query,
+                    "search_strategy": config.search_strategy_query_value,
+                    "schema": "product-offers-v0",
+                    "external": "true",
+                    "limit": "1",
+                },
+                timeout=REQUEST_TIMEOUT,
+            )
+        except requests.RequestException as e:
+            if attempt == MAX_RETRIES:
+                print(
+                    f"Warning: Could not fetch prices for {part_number} {manufacturer}: {e}",
+                    file=sys.stderr,
+                )
+                return None
+            time.sleep(RETRY_BACKOFF * 2**attempt)
+            continue
+
+        if search_response.status_code not in RETRY_STATUSES or attempt == MAX_RETRIES:
+            break
+        if search_response.status_code == 429:
+            # Everything sharing the rate limiter is going too fast, not just
+            # this request, so they all back off.
+            config.rate_limiter.pause(retry_after(search_response))
+        else:
+            time.sleep(RETRY_BACKOFF * 2**attempt)
 
     if search_response.status_code != 200:
         print(
@@ -93,7 +301,7 @@ def fetch_price_for_part(
         )
         return None
 
-    search_results = search_response.json()
+    search_results = orjson.loads(search_response.content)
     try:
         reference_prices = search_results.get("data", [])[0].get("reference_prices")
     except IndexError:
@@ -109,3 +317,54 @@ def fetch_price_for_part(
         cofactr_id=search_results["data"][0]["id"],
         prices=prices,
     )
+
+
+def retry_after(response: requests.Response) -> float:
+    """
+    Get how many seconds a rate limited response asks us to wait before
+    retrying.
+    """
+
+    try:
+        return max(float(response.headers["Retry-After"]), 0)
+    except (KeyError, ValueError):
+        # The header is missing, or is an HTTP date rather than a number of
+        # seconds.
+        return DEFAULT_RETRY_AFTER
+
+
+def fetch_prices_for_parts(
+    config: FetchConfig, parts: Iterable[tuple[str, str]]
+) -> Iterator[tuple[tuple[str, str], PartPrices | None]]:
+    """
+    Get the prices of many components.
+
+    `parts` is an iterable of `(part_number, manufacturer)` pairs. This yields
+    each pair with the result of `fetch_price_for_part` for it, in the order
+    the lookups finish.
+
+    The Cofactr products endpoint takes one query per request, so this runs
+    `fetch_price_for_part` for up to `MAX_CONCURRENT_REQUESTS` parts at once.
+    If the API you are using can look up many parts in a single request, you
+    can replace this function to send the parts in batches instead.
+
+    :param config: The session and search strategy to use.
+    :param parts: The part number and manufacturer pairs to search for.
+    :returns: An iterator of each pair and the prices found for it.
+    """
+
+    executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS)
+    try:
+        futures = {
+            executor.submit(fetch_price_for_part, config, part_number, manufacturer): (
+                part_number,
+                manufacturer,
+            )
+            for part_number, manufacturer in parts
+        }
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+    finally:
+        # If a lookup raises, or the user presses Ctrl-C, stop straight away
+        # rather than waiting for every queued lookup to finish first.
+        executor.shutdown(wait=False, cancel_futures=True)
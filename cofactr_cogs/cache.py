@@ -0,0 +1,119 @@
+import os
+import sqlite3
+import time
+
+import orjson
+
+from cofactr_cogs.api import PartPrices, SearchStrategy
+
+DEFAULT_CACHE_TTL = 24 * 60 * 60
+DEFAULT_CACHE_MAX_ENTRIES = 10_000
+
+
+def default_cache_dir() -> str:
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(cache_home, "cofactr_cogs")
+
+
+class PriceCache:
+    """
+    An on-disk cache of part prices fetched from Cofactr.
+
+    Pricing data changes slowly, and the same BOM is often costed many times,
+    so caching prices lets repeated runs skip the API entirely. Entries expire
+    after `ttl` seconds, and once there are more than `max_entries` entries the
+    least recently used ones are evicted.
+
+    Only successful lookups are cached, so parts that were not found or that
+    failed to fetch are retried on the next run.
+    """
+
+    def __init__(
+        self,
+        cache_dir: str,
+        ttl: int = DEFAULT_CACHE_TTL,
+        max_entries: int = DEFAULT_CACHE_MAX_ENTRIES,
+    ) -> None:
+        os.makedirs(cache_dir, exist_ok=True)
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.connection = sqlite3.connect(os.path.join(cache_dir, "prices.sqlite3"))
+        self.connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS prices (
+                part_number TEXT NOT NULL,
+                manufacturer TEXT NOT NULL,
+                search_strategy TEXT NOT NULL,
+                part_prices TEXT NOT NULL,
+                fetched_at REAL NOT NULL,
+                accessed_at REAL NOT NULL,
+                PRIMARY KEY (part_number, manufacturer, search_strategy)
+            )
+            """
+        )
+        self.connection.commit()
+
+    def get(
+        self, part_number: str, manufacturer: str, search_strategy: SearchStrategy
+    ) -> PartPrices | None:
+        now = time.time()
+        key = (part_number, manufacturer, search_strategy.value)
+        row = self.connection.execute(
+            "SELECT part_prices FROM prices "
+            + "WHERE part_number = ? AND manufacturer = ? AND search_strategy = ? "
+            + "AND fetched_at > ?",
+            (*key, now - self.ttl),
+        ).fetchone()
+        if row is None:
+            return None
+
+        self.connection.execute(
+            "UPDATE prices SET accessed_at = ? "
+            + "WHERE part_number = ? AND manufacturer = ? AND search_strategy = ?",
+            (now, *key),
+        )
+
+        cached = orjson.loads(row[0])
+        return PartPrices(
+            cofactr_id=cached["cofactr_id"],
+            prices={int(quantity): float(price) for quantity, price in cached["prices"]},
+        )
+
+    def set(
+        self,
+        part_number: str,
+        manufacturer: str,
+        search_strategy: SearchStrategy,
+        part_prices: PartPrices,
+    ) -> None:
+        now = time.time()
+        cached = orjson.dumps(
+            {
+                "cofactr_id": part_prices.cofactr_id,
+                "prices": list(part_prices.prices.items()),
+            }
+        ).decode()
+        self.connection.execute(
+            "INSERT OR REPLACE INTO prices VALUES (?, ?, ?, ?, ?, ?)",
+            (part_number, manufacturer, search_strategy.value, cached, now, now),
+        )
+
+    def evict(self) -> None:
+        """
+        Remove expired entries, and the least recently used entries beyond
+        `max_entries`.
+        """
+
+        self.connection.execute(
+            "DELETE FROM prices WHERE fetched_at <= ?", (time.time() - self.ttl,)
+        )
+        self.connection.execute(
+            "DELETE FROM prices WHERE rowid IN "
+            + "(SELECT rowid FROM prices ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,),
+        )
+        self.connection.commit()
+
+    def close(self) -> None:
+        self.connection.commit()
+        self.connection.close()
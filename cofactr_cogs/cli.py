@@ -4,11 +4,18 @@
 # run. You can use https://github.com/AllSpiceIO/generate-bom to generate a BOM
 # CSV.
 import csv
+import sqlite3
 import sys
-from argparse import ArgumentParser
+from argparse import ArgumentParser, BooleanOptionalAction
 from contextlib import ExitStack
 
-from cofactr_cogs.api import PartPrices, SearchStrategy, fetch_price_for_part
+from cofactr_cogs.api import (
+    DEFAULT_REQUESTS_PER_SECOND,
+    SearchStrategy,
+    fetch_config_from_environment,
+    fetch_prices_for_parts,
+)
+from cofactr_cogs.cache import DEFAULT_CACHE_TTL, PriceCache, default_cache_dir
 
 
 def main() -> None:
@@ -53,6 +60,31 @@ def main() -> None:
         "--output-file",
         help="The path to the output file. Defaults to stdout, i.e. printing to the console.",
     )
+    parser.add_argument(
+        "--max-requests-per-second",
+        help="The most requests per second to send to Cofactr, including retries.  Defaults to "
+        + "'%(default)s'.",
+        type=float,
+        default=DEFAULT_REQUESTS_PER_SECOND,
+    )
+    parser.add_argument(
+        "--cache-dir",
+        help=f"The directory to cache fetched prices in.  Defaults to '{default_cache_dir()}'.",
+        default="",
+    )
+    parser.add_argument(
+        "--cache-ttl",
+        help="How long, in seconds, cached prices are used for.  Defaults to '%(default)s'.",
+        type=int,
+        default=DEFAULT_CACHE_TTL,
+    )
+    parser.add_argument(
+        "--cache",
+        help="Whether to cache fetched prices, and use cached prices that haven't expired.  "
+        + "Use --no-cache to always fetch prices from Cofactr.  Defaults to caching.",
+        action=BooleanOptionalAction,
+        default=True,
+    )
     parser.add_argument(
         "--log-level",
         help="The log level to use.  Defaults to '%(default)s'.",
@@ -61,7 +93,9 @@ def main() -> None:
 
     args = parser.parse_args()
 
-    quantities = [int(quantity) for quantity in args.quantities.split(",")]
+    # Output the quantities in ascending order, and only once each, however they
+    # were given.
+    quantities = sorted({int(quantity) for quantity in args.quantities.split(",")})
 
     part_number_column = args.bom_part_number_column
     if not part_number_column:
@@ -76,39 +110,84 @@ def main() -> None:
             "BOM quantity column needs to be specified.  Please set bom_quantity_column."
         )
 
-    search_strategy = SearchStrategy(args.search_strategy)
+    fetch_config = fetch_config_from_environment(
+        SearchStrategy(args.search_strategy),
+        requests_per_second=args.max_requests_per_second,
+    )
+
+    use_mfr = bool(manufacturer_column)
+    if not use_mfr and fetch_config.needs_mfr:
+        raise ValueError(
+            "Search strategy requires manufacturer, but no BOM manufacturer column was provided.  Please set bom_manufacturer_column."
+        )
+
+    # The part number, manufacturer and quantity of each BOM row, read out of
+    # the CSV once so later loops don't have to look them up again.
+    part_numbers = []
+    manufacturers = []
+    part_quantities = []
 
     with open(args.bom_file, "r") as bom_file:
-        bom_csv = csv.DictReader(bom_file)
+        bom_csv = csv.reader(bom_file)
 
-        parts = [
-            part for part in bom_csv if part[part_number_column] and part[part_number_column] != ""
-        ]
+        header = next(bom_csv, [])
+        part_number_index = column_index(header, part_number_column)
+        manufacturer_index = column_index(header, manufacturer_column) if use_mfr else None
+        quantity_index = column_index(header, quantity_column)
 
-    print(f"Computing COGS for {len(parts)} parts", file=sys.stderr)
-    print(f"Fetching prices for {len(parts)} parts", file=sys.stderr)
+        for row in bom_csv:
+            if len(row) <= part_number_index or not row[part_number_index]:
+                continue
+            part_numbers.append(row[part_number_index])
+            manufacturers.append(row[manufacturer_index] if manufacturer_index is not None else "")
+            part_quantities.append(int(row[quantity_index]))
 
+    print(f"Computing COGS for {len(part_numbers)} parts", file=sys.stderr)
     prices_for_parts = {}
 
-    use_mfr = bool(manufacturer_column)
-    if not use_mfr and search_strategy.query_needs_manufacturer():
-        raise ValueError(
-            "Search strategy requires manufacturer, but no BOM manufacturer column was provided.  Please set bom_manufacturer_column."
-        )
-
     if args.log_level.lower() == "debug":
         print(f"Using part number column: {part_number_column!r}", file=sys.stderr)
         print(f"Using manufacturer column: {manufacturer_column!r}", file=sys.stderr)
         print(f"Using use_mfr: {use_mfr!r}", file=sys.stderr)
         print(f"Using quantity column: {quantity_column!r}", file=sys.stderr)
-        print(f"Using search strategy: {search_strategy!r}", file=sys.stderr)
+        print(f"Using search strategy: {fetch_config.search_strategy!r}", file=sys.stderr)
+
+    # The same part often appears on many rows of a BOM, so only look up each
+    # part number and manufacturer pair once. Each row's part is then referred
+    # to by its index in `part_keys`.
+    part_keys = list(dict.fromkeys(zip(part_numbers, manufacturers)))
+    part_key_indices = {key: i for i, key in enumerate(part_keys)}
+    row_part_indices = [part_key_indices[key] for key in zip(part_numbers, manufacturers)]
 
-    for part in parts:
-        part_number = part[part_number_column]
-        manufacturer = part[manufacturer_column] if use_mfr else ""
-        part_prices = fetch_price_for_part(part_number, manufacturer, search_strategy)
-        if part_prices is not None and len(part_prices.prices) > 0:
-            prices_for_parts[(part_number, manufacturer)] = part_prices
+    with ExitStack() as stack:
+        cache = None
+        if args.cache:
+            try:
+                cache = PriceCache(args.cache_dir or default_cache_dir(), ttl=args.cache_ttl)
+                stack.callback(cache.close)
+            except (OSError, sqlite3.Error) as e:
+                print(f"Warning: Not caching prices, could not open cache: {e}", file=sys.stderr)
+
+        keys_to_fetch = []
+        for key in part_keys:
+            cached_prices = cache.get(*key, fetch_config.search_strategy) if cache else None
+            if cached_prices is not None:
+                prices_for_parts[key] = cached_prices
+            else:
+                keys_to_fetch.append(key)
+
+        if len(prices_for_parts) > 0:
+            print(f"Using cached prices for {len(prices_for_parts)} parts", file=sys.stderr)
+        print(f"Fetching prices for {len(keys_to_fetch)} unique parts", file=sys.stderr)
+
+        for key, part_prices in fetch_prices_for_parts(fetch_config, keys_to_fetch):
+            if part_prices is not None and len(part_prices.prices) > 0:
+                prices_for_parts[key] = part_prices
+                if cache:
+                    cache.set(*key, fetch_config.search_strategy, part_prices)
+
+        if cache:
+            cache.evict()
 
     print(f"Found prices for {len(prices_for_parts)} parts", file=sys.stderr)
 
@@ -131,38 +210,17 @@ def main() -> None:
 
     assert len(headers) == expected_columns
 
-    rows = []
-    totals: dict[int, float] = {quantity: 0 for quantity in quantities}
-
-    for part in parts:
-        part_number = part[part_number_column]
-        manufacturer = part[manufacturer_column] if use_mfr else ""
-        part_quantity = int(part[quantity_column])
+    # Work out the unit price at each quantity once per unique part, rather than
+    # once per BOM row that uses the part. Both lists are indexed like
+    # `part_keys`.
+    part_prices_by_index = [prices_for_parts.get(key) for key in part_keys]
+    unit_prices_by_index = [
+        [part_prices.price_at(quantity) for quantity in quantities] if part_prices else None
+        for part_prices in part_prices_by_index
+    ]
+    no_price_columns: list[float | None] = [None] * (2 * len(quantities))
 
-        part_prices = prices_for_parts.get((part_number, manufacturer))
-        cofactr_id = part_prices.cofactr_id if part_prices else None
-
-        current_row = [part_number]
-        if use_mfr:
-            current_row.append(manufacturer)
-        current_row.append(cofactr_id)
-        current_row.append(part_quantity)
-
-        for quantity in quantities:
-            breakpoints = price_breakpoints(part_prices, quantity)
-            if part_prices and breakpoints:
-                largest_breakpoint_less_than_qty = max(breakpoints)
-                price_at_breakpoint = part_prices.prices[largest_breakpoint_less_than_qty]
-                current_row.append(price_at_breakpoint)
-                total_for_part_at_quantity = price_at_breakpoint * part_quantity
-                current_row.append(total_for_part_at_quantity)
-                totals[quantity] += total_for_part_at_quantity
-            else:
-                current_row.append(None)
-                current_row.append(None)
-
-        assert len(current_row) == expected_columns
-        rows.append(current_row)
+    totals: list[float] = [0] * len(quantities)
 
     with ExitStack() as stack:
         if args.output_file:
@@ -172,14 +230,47 @@ def main() -> None:
             writer = csv.writer(sys.stdout)
 
         writer.writerow(headers)
-        writer.writerows(rows)
+
+        # Write each row as soon as it is computed, rather than holding the
+        # whole output in memory.
+        for part_number, manufacturer, part_quantity, part_index in zip(
+            part_numbers, manufacturers, part_quantities, row_part_indices
+        ):
+            part_prices = part_prices_by_index[part_index]
+            cofactr_id = part_prices.cofactr_id if part_prices else None
+
+            unit_prices = unit_prices_by_index[part_index]
+            price_columns: list[float | None]
+            if unit_prices is not None:
+                line_totals = [
+                    unit_price * part_quantity if unit_price is not None else None
+                    for unit_price in unit_prices
+                ]
+                # Interleave the unit prices and totals: per unit, then total at
+                # each quantity.
+                price_columns = [
+                    column for pair in zip(unit_prices, line_totals) for column in pair
+                ]
+                for i, line_total in enumerate(line_totals):
+                    if line_total is not None:
+                        totals[i] += line_total
+            else:
+                price_columns = no_price_columns
+
+            if use_mfr:
+                current_row = [part_number, manufacturer, cofactr_id, part_quantity, *price_columns]
+            else:
+                current_row = [part_number, cofactr_id, part_quantity, *price_columns]
+
+            assert len(current_row) == expected_columns
+            writer.writerow(current_row)
 
         totals_row = ["Totals", None, None]
         if use_mfr:
             totals_row.append(None)
-        for quantity in quantities:
+        for total in totals:
             totals_row.append(None)
-            totals_row.append(str(totals[quantity]))
+            totals_row.append(str(total))
 
         assert len(totals_row) == expected_columns
         writer.writerow(totals_row)
@@ -187,11 +278,11 @@ def main() -> None:
     print("Computed COGS", file=sys.stderr)
 
 
-def price_breakpoints(part_prices: PartPrices | None, quantity: int) -> list[int] | None:
-    if part_prices is None:
-        return None
-    breakpoints = [breakpoint for breakpoint in part_prices.prices.keys() if breakpoint <= quantity]
-    return breakpoints if len(breakpoints) > 0 else None
+def column_index(header: list[str], column: str) -> int:
+    try:
+        return header.index(column)
+    except ValueError:
+        raise ValueError(f"Column {column!r} not found in BOM file.") from None
 
 
 if __name__ == "__main__":
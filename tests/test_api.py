@@ -0,0 +1,218 @@
+import threading
+import time
+import unittest
+from collections.abc import Iterator
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+import orjson
+
+from cofactr_cogs import api
+
+SEARCH_RESULTS = {
+    "data": [
+        {
+            "id": "CCV1XXXXXXXX",
+            "reference_prices": [
+                {"quantity": 1, "price": 0.5},
+                {"quantity": 10, "price": 0.45},
+            ],
+        }
+    ]
+}
+
+# Statuses that make `fake_cofactr` misbehave instead of responding: close the
+# connection without a response, or stall for longer than the test's timeout.
+DROP_CONNECTION = 0
+STALL = -1
+
+
+@contextmanager
+def fake_cofactr(responses: list[tuple[int, dict[str, str]]]) -> Iterator[list[str]]:
+    """
+    Serve the Cofactr products endpoint locally, and point `api` at it.
+
+    Each request is answered with the next status code and headers in
+    `responses`, and once they run out, with `SEARCH_RESULTS`. Yields the list
+    of paths that have been requested.
+
+    Requests are retried straight away, and time out after 0.1 seconds, so
+    that tests of retries are quick.
+    """
+
+    requested: list[str] = []
+    remaining = list(responses)
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self) -> None:
+            requested.append(self.path)
+            status, headers = remaining.pop(0) if remaining else (200, {})
+            if status == DROP_CONNECTION:
+                self.close_connection = True
+                return
+            if status == STALL:
+                time.sleep(0.5)
+                self.close_connection = True
+                return
+            body = orjson.dumps(SEARCH_RESULTS) if status == 200 else b""
+            self.send_response(status)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format: str, *args: object) -> None:
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/products/"
+    try:
+        with (
+            mock.patch.object(api, "COFACTR_PRODUCTS_URL", url),
+            mock.patch.object(api, "RETRY_BACKOFF", 0),
+            mock.patch.object(api, "REQUEST_TIMEOUT", 0.1),
+        ):
+            yield requested
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def fetch_config() -> api.FetchConfig:
+    session = api.create_session("api-key", "client-id")
+    # Mount the adapter for http:// too, so requests to the local server use the
+    # same connection pool settings.
+    session.mount("http://", session.get_adapter("https://"))
+    return api.FetchConfig(
+        session=session,
+        rate_limiter=api.RateLimiter(100),
+        search_strategy=api.SearchStrategy.MPN_SKU_MFR,
+        search_strategy_query_value=api.SearchStrategy.MPN_SKU_MFR.to_query_value(),
+        needs_mfr=True,
+    )
+
+
+class FetchPriceForPartTest(unittest.TestCase):
+    def test_fetches_prices(self) -> None:
+        with fake_cofactr([]) as requested:
+            part_prices = api.fetch_price_for_part(fetch_config(), "RC0603FR-0710KL", "Yageo")
+
+        self.assertEqual(len(requested), 1)
+        self.assertEqual(part_prices, api.PartPrices("CCV1XXXXXXXX", {1: 0.5, 10: 0.45}))
+
+    def test_rate_limited_responses_pause_the_rate_limiter(self) -> None:
+        config = fetch_config()
+        responses = [(429, {"Retry-After": "0"}), (429, {"Retry-After": "0"})]
+
+        with (
+            fake_cofactr(responses) as requested,
+            mock.patch.object(config.rate_limiter, "pause") as pause,
+        ):
+            part_prices = api.fetch_price_for_part(config, "RC0603FR-0710KL", "Yageo")
+
+        self.assertIsNotNone(part_prices)
+        self.assertEqual(len(requested), 3)
+        self.assertEqual(pause.call_args_list, [mock.call(0.0), mock.call(0.0)])
+
+    def test_server_errors_are_retried_through_the_rate_limiter(self) -> None:
+        config = fetch_config()
+
+        with (
+            fake_cofactr([(503, {})]) as requested,
+            mock.patch.object(config.rate_limiter, "wait") as wait,
+        ):
+            part_prices = api.fetch_price_for_part(config, "RC0603FR-0710KL", "Yageo")
+
+        self.assertIsNotNone(part_prices)
+        self.assertEqual(len(requested), 2)
+        self.assertEqual(wait.call_count, 2)
+
+    def test_gives_up_after_max_retries(self) -> None:
+        config = fetch_config()
+        responses = [(429, {"Retry-After": "0"})] * (api.MAX_RETRIES + 1)
+
+        with fake_cofactr(responses) as requested:
+            part_prices = api.fetch_price_for_part(config, "RC0603FR-0710KL", "Yageo")
+
+        self.assertIsNone(part_prices)
+        self.assertEqual(len(requested), api.MAX_RETRIES + 1)
+
+    def test_connection_errors_are_retried(self) -> None:
+        with fake_cofactr([(DROP_CONNECTION, {}), (STALL, {})]) as requested:
+            part_prices = api.fetch_price_for_part(fetch_config(), "RC0603FR-0710KL", "Yageo")
+
+        self.assertIsNotNone(part_prices)
+        self.assertEqual(len(requested), 3)
+
+    def test_gives_up_on_connection_errors_after_max_retries(self) -> None:
+        responses: list[tuple[int, dict[str, str]]] = [(DROP_CONNECTION, {})] * (
+            api.MAX_RETRIES + 1
+        )
+
+        with fake_cofactr(responses) as requested:
+            part_prices = api.fetch_price_for_part(fetch_config(), "RC0603FR-0710KL", "Yageo")
+
+        self.assertIsNone(part_prices)
+        self.assertEqual(len(requested), api.MAX_RETRIES + 1)
+
+
+class FetchPricesForPartsTest(unittest.TestCase):
+    def test_stops_without_waiting_for_queued_lookups_when_one_raises(self) -> None:
+        def fetch_price_for_part(
+            config: api.FetchConfig, part_number: str, manufacturer: str
+        ) -> api.PartPrices | None:
+            if part_number == "P0":
+                raise RuntimeError("Lookup failed")
+            time.sleep(0.5)
+            return None
+
+        parts = [(f"P{i}", "") for i in range(4 * api.MAX_CONCURRENT_REQUESTS)]
+        start = time.monotonic()
+        with (
+            mock.patch.object(api, "fetch_price_for_part", fetch_price_for_part),
+            self.assertRaises(RuntimeError),
+        ):
+            list(api.fetch_prices_for_parts(fetch_config(), parts))
+
+        # Waiting for every lookup would take 4 rounds of 0.5s.
+        self.assertLess(time.monotonic() - start, 1.0)
+
+
+class RateLimiterTest(unittest.TestCase):
+    def test_paces_requests_after_a_burst(self) -> None:
+        rate_limiter = api.RateLimiter(20)
+        start = time.monotonic()
+        for _ in range(30):
+            rate_limiter.wait()
+
+        # 20 requests in the burst, then 10 more at 20 per second.
+        self.assertGreaterEqual(time.monotonic() - start, 0.45)
+
+    def test_pause_holds_back_callers_already_waiting(self) -> None:
+        rate_limiter = api.RateLimiter(2)
+        rate_limiter.wait()
+        rate_limiter.wait()
+
+        start = time.monotonic()
+        sent_at: list[float] = []
+
+        def send() -> None:
+            rate_limiter.wait()
+            sent_at.append(time.monotonic())
+
+        thread = threading.Thread(target=send)
+        # Without the pause the thread would be let through after 0.5s.
+        thread.start()
+        time.sleep(0.05)
+        rate_limiter.pause(1.0)
+        thread.join()
+
+        self.assertGreaterEqual(sent_at[0] - start, 1.0)
+
+
+if __name__ == "__main__":
+    unittest.main()